@@ -0,0 +1,77 @@
+import functools
+import torch
+from sentence_transformers import SentenceTransformer
+from langchain_core.embeddings import Embeddings
+
+# Embedding model
+EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+ONNX_FILE_NAME = 'onnx/model_qint8_avx512_vnni.onnx'
+EMBEDDING_BACKEND = 'onnx'  # 'onnx' or 'torch'
+COMPILE_EMBEDDINGS = False  # wrap the 'torch' backend in torch.compile
+
+# Run on the GPU when one is available
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+class MiniLMEmbeddings(Embeddings):
+    """
+    LangChain embeddings for the MiniLM sentence encoder
+
+    The 'onnx' backend runs the INT8-quantized ONNX export with ONNX Runtime,
+    which fuses the encoder ops and runs the quantized GEMMs with VNNI
+    instructions. The 'torch' backend runs the PyTorch model, in FP16 on
+    the GPU. With `compile_model=True` it is wrapped in torch.compile,
+    which fuses attention and MLP ops and removes Python dispatch overhead
+    (not supported on every platform, e.g. Windows with torch 2.3)
+
+    Embeddings are L2-normalized, so inner product equals cosine similarity
+    """
+    def __init__(self, model_name=EMBEDDING_MODEL, backend=EMBEDDING_BACKEND,
+                 file_name=ONNX_FILE_NAME, device=DEVICE,
+                 compile_model=COMPILE_EMBEDDINGS):
+        if backend == 'onnx':
+            self.client = SentenceTransformer(
+                model_name,
+                backend='onnx',
+                model_kwargs={'file_name': file_name}
+            )
+        else:
+            self.client = SentenceTransformer(
+                model_name,
+                device=device,
+                model_kwargs={
+                    'torch_dtype': torch.float16 if device == 'cuda' else torch.float32
+                }
+            )
+            if compile_model:
+                transformer = self.client[0]
+                transformer.auto_model = torch.compile(
+                    transformer.auto_model,
+                    mode='reduce-overhead',
+                    dynamic=True
+                )
+
+    def embed_documents(self, texts):
+        return self.client.encode(
+            texts,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).tolist()
+
+    def embed_query(self, text):
+        return self.client.encode(
+            text,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).tolist()
+
+@functools.lru_cache(maxsize=1)
+def get_embeddings():
+    """
+    Return the shared embedding model, loading it on first use
+    
+    The quantized ONNX model targets the CPU, so the GPU always uses the
+    'torch' backend
+    """
+    if DEVICE == 'cuda':
+        return MiniLMEmbeddings(backend='torch')
+    return MiniLMEmbeddings()
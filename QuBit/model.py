@@ -1,12 +1,25 @@
 import os
 import sys
+import pickle
+import asyncio
+import functools
+import hashlib
+import threading
 import torch
+import faiss
+import numpy as np
 import chainlit as cl
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from collections import OrderedDict
+from typing import Any, List
+from sentence_transformers.quantization import quantize_embeddings
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
-from langchain_community.llms import CTransformers
+from langchain_community.llms import LlamaCpp
+from embeddings import DEVICE, get_embeddings
 
 # Set encoding to UTF-8
 sys.stdout.reconfigure(encoding='utf-8')
@@ -14,7 +27,29 @@ sys.stderr.reconfigure(encoding='utf-8')
 
 # Paths
 DB_FAISS_PATH = 'vectorstore/db_faiss'
-LLM_PATH = 'llama-2-7b-chat.ggmlv3.q8_0.bin'
+BINARY_INDEX_FILE = 'index_binary.faiss'
+EMBEDDINGS_FILE = 'embs.npy'
+LLM_PATH = 'llama-2-7b-chat.Q4_K_M.gguf'
+
+# Index that serves queries: 'binary' searches index_binary.faiss and rescores
+# with embs.npy, 'float' searches index.faiss (e.g. after rebuild_index())
+RETRIEVAL_INDEX = 'binary'
+
+# Move the vector index to the GPU(s) from this many vectors on
+GPU_INDEX_MIN_VECTORS = 1_000_000
+
+# Vector store shared by all chat sessions, see _get_db()
+_DB = None
+
+# LLM shared by all chat sessions, see _get_llm(). A llama.cpp context can
+# only run one generation at a time, so generations hold _LLM_LOCK
+_LLM = None
+_LLM_LOCK = asyncio.Lock()
+
+# Retrieval results shared by all chat sessions, see CachedRetriever
+RETRIEVAL_CACHE_SIZE = 1024
+_RETRIEVAL_CACHE = OrderedDict()
+_RETRIEVAL_CACHE_LOCK = threading.Lock()
 
 # Custom Prompt Template
 custom_prompt_template = """You are an AI assistant specializing in Morocco tourism. 
@@ -36,7 +71,7 @@ def set_custom_prompt():
 
 def load_llm():
     """
-    Load the GGML model using CTransformers
+    Load the GGUF model using llama.cpp (llama-cpp-python)
     """
     try:
         if not os.path.exists(LLM_PATH):
@@ -45,13 +80,19 @@ def load_llm():
             return None
         
         # Load the model
-        llm = CTransformers(
-            model=LLM_PATH,
-            model_type="llama",
-            max_new_tokens=512,
+        llm = LlamaCpp(
+            model_path=LLM_PATH,
+            n_ctx=2048,
+            n_batch=512,
+            n_threads=os.cpu_count(),
+            n_gpu_layers=-1 if DEVICE == 'cuda' else 0,
+            use_mlock=True,
+            max_tokens=512,
             temperature=0.5,
             top_p=0.8,
-            repetition_penalty=1.1
+            top_k=40,
+            repeat_penalty=1.15,
+            streaming=True
         )
         return llm
     
@@ -61,48 +102,168 @@ def load_llm():
         traceback.print_exc()
         return None
 
-def retrieval_qa_chain(llm, prompt, db):
+def _get_llm():
     """
-    Create a Retrieval QA Chain
+    Load the LLM once per process and share it across chat sessions
+    
+    Each load maps (and with use_mlock pins) the whole GGUF file, so it must
+    not be repeated for every new chat
     """
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type='stuff',
-        retriever=db.as_retriever(
+    global _LLM
+    if _LLM is None:
+        _LLM = load_llm()
+    return _LLM
+
+def _get_db():
+    """
+    Load the vector store once per process and share it across chat sessions
+    
+    The index is opened memory-mapped and read-only, so its pages stay in
+    the OS page cache instead of being deserialized for every new chat
+    """
+    global _DB
+    if _DB is None:
+        index = faiss.read_index(
+            os.path.join(DB_FAISS_PATH, 'index.faiss'),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+        
+        # Same layout FAISS.save_local writes next to the index
+        with open(os.path.join(DB_FAISS_PATH, 'index.pkl'), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        
+        _DB = FAISS(
+            embedding_function=get_embeddings(),
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+    return _DB
+
+class BinaryRerankRetriever(BaseRetriever):
+    """
+    Two-stage retriever: Hamming search over the binary index, then
+    rescoring of the top candidates with the float32 embeddings
+    """
+    db: Any
+    binary_index: Any
+    embs: Any
+    k: int = 3
+    rescore_k: int = 100
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        q = np.array(self.db.embeddings.embed_query(query), dtype=np.float32)
+        
+        # First stage: POPCNT-based Hamming search over packed bits
+        q_bin = quantize_embeddings(q.reshape(1, -1), precision='ubinary')
+        _, candidates = self.binary_index.search(q_bin, self.rescore_k)
+        candidates = candidates[0][candidates[0] >= 0]
+        
+        # Second stage: exact cosine similarity on the candidates only
+        scores = self.embs[candidates] @ q
+        top = candidates[np.argsort(-scores)[:self.k]]
+        
+        return [
+            self.db.docstore.search(self.db.index_to_docstore_id[i])
+            for i in top
+        ]
+
+class CachedRetriever(BaseRetriever):
+    """
+    LRU cache in front of another retriever, keyed on the query text
+
+    The cache is shared by all chat sessions, so a repeated question skips
+    both the query embedding and the index search
+    """
+    retriever: Any
+
+    def _get_relevant_documents(self, query, *, run_manager) -> List[Document]:
+        key = hashlib.sha1(query.encode('utf-8')).hexdigest()
+        with _RETRIEVAL_CACHE_LOCK:
+            if key in _RETRIEVAL_CACHE:
+                _RETRIEVAL_CACHE.move_to_end(key)
+                return list(_RETRIEVAL_CACHE[key])
+        
+        docs = self.retriever.invoke(
+            query,
+            config={'callbacks': run_manager.get_child()}
+        )
+        
+        with _RETRIEVAL_CACHE_LOCK:
+            _RETRIEVAL_CACHE[key] = docs
+            _RETRIEVAL_CACHE.move_to_end(key)
+            if len(_RETRIEVAL_CACHE) > RETRIEVAL_CACHE_SIZE:
+                _RETRIEVAL_CACHE.popitem(last=False)
+        return list(docs)
+
+@functools.lru_cache(maxsize=1)
+def load_retriever(db):
+    """
+    Create the retriever behind a shared LRU cache, once per process
+    
+    With RETRIEVAL_INDEX = 'binary' (and the binary index built) it uses
+    binary search with float32 rescoring; otherwise it searches the float
+    index directly, copied to all available GPUs when it is very large
+    """
+    binary_path = os.path.join(DB_FAISS_PATH, BINARY_INDEX_FILE)
+    embs_path = os.path.join(DB_FAISS_PATH, EMBEDDINGS_FILE)
+    use_binary = (
+        RETRIEVAL_INDEX == 'binary'
+        and os.path.exists(binary_path)
+        and os.path.exists(embs_path)
+    )
+    if not use_binary:
+        if faiss.get_num_gpus() > 0 and db.index.ntotal >= GPU_INDEX_MIN_VECTORS:
+            db.index = faiss.index_cpu_to_all_gpus(db.index)
+        retriever = db.as_retriever(
             search_kwargs={
                 'k': 3,
                 'search_type': 'similarity'
             }
-        ),
+        )
+    else:
+        retriever = BinaryRerankRetriever(
+            db=db,
+            binary_index=faiss.read_index_binary(binary_path),
+            embs=np.load(embs_path, mmap_mode='r'),
+            k=3
+        )
+    
+    return CachedRetriever(retriever=retriever)
+
+def retrieval_qa_chain(llm, prompt, retriever):
+    """
+    Create a Retrieval QA Chain
+    """
+    qa_chain = RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type='stuff',
+        retriever=retriever,
         return_source_documents=True,
         chain_type_kwargs={'prompt': prompt}
     )
     return qa_chain
 
-def qa_bot():
+def load_qa_components():
     """
-    Initialize QA Bot with embeddings, vector store, and LLM
+    Initialize embeddings, vector store, and LLM
+    
+    Returns a (retriever, llm) pair, or None if anything failed to load
     """
     try:
-        # Load embeddings
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'}
-        )
-        
         # Verify vector store path exists
         if not os.path.exists(DB_FAISS_PATH):
             print(f"Error: Vector store path not found: {DB_FAISS_PATH}")
             print("Current directory contents:", os.listdir())
             return None
         
+        # Warm up the encoder so any compilation happens now, not on the first query
+        get_embeddings().embed_query("Morocco")
+        
         # Load vector store
         try:
-            db = FAISS.load_local(
-                DB_FAISS_PATH, 
-                embeddings,
-                allow_dangerous_deserialization=True
-            )
+            db = _get_db()
         except Exception as db_error:
             print(f"Error loading vector store: {db_error}")
             import traceback
@@ -110,18 +271,12 @@ def qa_bot():
             return None
         
         # Load LLM
-        llm = load_llm()
+        llm = _get_llm()
         if not llm:
             print("Error: Could not load language model")
             return None
         
-        # Set custom prompt
-        qa_prompt = set_custom_prompt()
-        
-        # Create QA chain
-        qa = retrieval_qa_chain(llm, qa_prompt, db)
-        
-        return qa
+        return load_retriever(db), llm
     
     except Exception as e:
         print(f"Error setting up QA bot: {e}")
@@ -129,6 +284,24 @@ def qa_bot():
         traceback.print_exc()
         return None
 
+def qa_bot():
+    """
+    Initialize QA Bot with embeddings, vector store, and LLM
+    
+    The chat handlers use the lighter path in main(); this RetrievalQA
+    chain is kept for other callers
+    """
+    components = load_qa_components()
+    if not components:
+        return None
+    retriever, llm = components
+    
+    # Set custom prompt
+    qa_prompt = set_custom_prompt()
+    
+    # Create QA chain
+    return retrieval_qa_chain(llm, qa_prompt, retriever)
+
 ##############################################
 # Chainlit Chat Interface
 @cl.on_chat_start
@@ -141,14 +314,16 @@ async def start():
     await msg.send()
     
     try:
-        # Setup QA chain
-        chain = qa_bot()
-        if not chain:
+        # Setup retriever and LLM
+        components = load_qa_components()
+        if not components:
             await cl.Message(content="Failed to initialize the chatbot. Please check your setup.").send()
             return
+        retriever, llm = components
         
-        # Store chain in user session
-        cl.user_session.set("chain", chain)
+        # Store retriever and LLM in user session
+        cl.user_session.set("retriever", retriever)
+        cl.user_session.set("llm", llm)
         
         # Welcome message
         await cl.Message(content="Salam! Welcome to the Morocco Tourism Chatbot! Ask me anything about traveling in Morocco.").send()
@@ -203,37 +378,35 @@ async def main(message: cl.Message):
     """
     Process incoming messages
     """
-    # Retrieve the QA chain
-    chain = cl.user_session.get("chain")
+    # Retrieve the retriever and LLM
+    retriever = cl.user_session.get("retriever")
+    llm = cl.user_session.get("llm")
     
-    # Create a callback handler for streaming
-    cb = cl.AsyncLangchainCallbackHandler(
-        stream_final_answer=True,
-        answer_prefix_tokens=["FINAL", "ANSWER"]
-    )
-    cb.answer_reached = True
+    # Create a callback handler per message: it tracks the steps of one
+    # run and its parent context. main() streams the answer itself
+    cb = cl.AsyncLangchainCallbackHandler()
     
     try:
-        # Process the query
-        res = await chain.acall(message.content, callbacks=[cb])
-        answer = res["result"]
-        
-        # Truncate if the answer seems cut off
-        if answer.endswith('Marrak'):
-            answer = answer.rstrip('Marrak')
+        # Retrieve context and fill the prompt directly, without RetrievalQA
+        docs = await retriever.ainvoke(message.content)
+        context = "\n\n".join(doc.page_content for doc in docs)
+        prompt = custom_prompt_template.format(
+            context=context,
+            question=message.content
+        )
         
-        # Remove repetitive information
-        lines = answer.split('\n')
-        unique_lines = []
-        seen = set()
-        for line in lines:
-            if line not in seen:
-                unique_lines.append(line)
-                seen.add(line)
+        # Process the query, streaming tokens to the UI as they are generated
+        msg = cl.Message(content="")
+        await msg.send()
+        async with _LLM_LOCK:
+            async for token in llm.astream(prompt, config={"callbacks": [cb]}):
+                await msg.stream_token(token)
         
-        answer = '\n'.join(unique_lines)
+        # Truncate if the answer seems cut off
+        if msg.content.endswith('Marrak'):
+            msg.content = msg.content.rstrip('Marrak')
         
-        await cl.Message(content=answer).send()
+        await msg.update()
     
     except Exception as e:
         print(f"Detailed Query Processing Error: {e}")
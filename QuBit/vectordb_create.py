@@ -1,71 +1,200 @@
-import json
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import os
+import uuid
+import ijson
+import faiss
+import numpy as np
+from itertools import chain, islice
+from joblib import Parallel, delayed
+from sentence_transformers.quantization import quantize_embeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
+from embeddings import get_embeddings
 
 # Paths
 DATA_PATH = 'deduplicated_dataset.json'
 DB_FAISS_PATH = 'vectorstore/db_faiss'
+BINARY_INDEX_FILE = 'index_binary.faiss'
+EMBEDDINGS_FILE = 'embs.npy'
+
+# Index settings
+EMBEDDING_DIM = 384
+IVF_NLIST = 1024
+IVF_MIN_CHUNKS = 39 * IVF_NLIST  # faiss needs ~39 training points per IVF cell
+PQ_M = 32  # each vector is compressed to PQ_M bytes
+PQ_NBITS = 8
+IVF_NPROBE = 16  # cells scanned per query: raise for recall, lower for latency
+
+# Dataset fields combined into each document, with their labels
+DOCUMENT_FIELDS = (
+    ('Instruction', 'instruction'),
+    ('Input', 'input'),
+    ('Output', 'output'),
+    ('Category', 'category'),
+)
+
+# Number of documents handed to the text splitter at a time
+SPLIT_BATCH_SIZE = 1024
+
+def iter_documents(file_path):
+    """
+    Stream the JSON dataset and yield LangChain Documents one at a time
+    
+    Each document will combine instruction, input, output, and category
+    to create a comprehensive searchable text; empty fields are left out.
+    Items are parsed incrementally, so memory use does not grow with the
+    file size
+    """
+    with open(file_path, 'rb') as f:
+        for item in ijson.items(f, 'item'):
+            # Combine all non-empty fields into a single text
+            text = "\n".join(
+                f"{label}: {item[key]}"
+                for label, key in DOCUMENT_FIELDS
+                if item.get(key)
+            )
+            
+            # Create a LangChain Document
+            yield Document(
+                page_content=text,
+                metadata={
+                    'source': 'morocco_tourism_dataset',
+                    'category': item.get('category', ''),
+                    'original_instruction': item.get('instruction', '')
+                }
+            )
 
 def load_json_dataset(file_path):
     """
     Load JSON dataset and convert to LangChain Documents
+    """
+    return list(iter_documents(file_path))
+
+def iter_batches(iterable, size):
+    """
+    Yield lists of up to `size` consecutive items from an iterable
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def build_index(embs):
+    """
+    Build the FAISS index for the chunk embeddings
     
-    Each document will combine instruction, input, output, and category
-    to create a comprehensive searchable text
-    """
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    documents = []
-    for item in data:
-        # Combine all relevant fields into a single text
-        text = f"Instruction: {item.get('instruction', '')}\n" \
-               f"Input: {item.get('input', '')}\n" \
-               f"Output: {item.get('output', '')}\n" \
-               f"Category: {item.get('category', '')}"
+    Small corpora use an exact flat index; larger ones use IVF-PQ, which
+    only scans IVF_NPROBE of the IVF_NLIST cells per query and stores
+    each vector as PQ_M bytes. Embeddings are normalized, so both search
+    by inner product (cosine similarity). When GPUs are available the
+    IVF-PQ index is trained once on the first GPU, then sharded across all
+    GPUs for the add step and copied back to the CPU for saving
+    """
+    if len(embs) < IVF_MIN_CHUNKS:
+        index = faiss.IndexFlatIP(EMBEDDING_DIM)
+        index.add(embs)
+        return index
+    
+    quantizer = faiss.IndexFlatIP(EMBEDDING_DIM)
+    index = faiss.IndexIVFPQ(
+        quantizer, EMBEDDING_DIM, IVF_NLIST, PQ_M, PQ_NBITS,
+        faiss.METRIC_INNER_PRODUCT
+    )
+    
+    if faiss.get_num_gpus() > 0:
+        # Train the coarse quantizer and PQ codebooks once, on a single GPU
+        res = faiss.StandardGpuResources()
+        gpu_index = faiss.index_cpu_to_gpu(res, 0, index)
+        gpu_index.train(embs)
+        index = faiss.index_gpu_to_cpu(gpu_index)
         
-        # Create a LangChain Document
-        doc = Document(
-            page_content=text,
-            metadata={
-                'source': 'morocco_tourism_dataset',
-                'category': item.get('category', ''),
-                'original_instruction': item.get('instruction', '')
-            }
-        )
-        documents.append(doc)
+        # Each GPU adds a slice of the vectors against the shared quantizer;
+        # the shards are merged back into one index on the way to the CPU
+        co = faiss.GpuMultipleClonerOptions()
+        co.shard = True
+        co.common_ivf_quantizer = True
+        gpu_index = faiss.index_cpu_to_all_gpus(index, co=co)
+        gpu_index.add(embs)
+        index = faiss.index_gpu_to_cpu(gpu_index)
+    else:
+        index.train(embs)
+        index.add(embs)
     
-    return documents
+    index.nprobe = IVF_NPROBE
+    return index
+
+def build_binary_index(embs):
+    """
+    Build a Hamming-distance FAISS index over binary-quantized embeddings
+    
+    Each 384-d float32 vector is packed into 48 bytes (one bit per
+    dimension), 32x smaller than the float index
+    """
+    bin_embs = quantize_embeddings(embs, precision='ubinary')
+    index = faiss.IndexBinaryFlat(EMBEDDING_DIM)
+    index.add(bin_embs)
+    return index
 
 def create_vector_db():
     """
     Create a FAISS vector database from the JSON dataset
     """
-    # Load documents from JSON
-    documents = load_json_dataset(DATA_PATH)
-    
     # Text splitter to chunk documents
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,
         chunk_overlap=50
     )
     
-    # Split documents into smaller chunks
-    texts = text_splitter.split_documents(documents)
+    # Stream documents from JSON and split them into smaller chunks,
+    # one batch per worker process
+    batches = iter_batches(iter_documents(DATA_PATH), SPLIT_BATCH_SIZE)
+    texts = list(chain.from_iterable(
+        Parallel(n_jobs=-1, backend='loky')(
+            delayed(text_splitter.split_documents)(batch) for batch in batches
+        )
+    ))
     
     # Initialize embeddings
-    embeddings = HuggingFaceEmbeddings(
-        model_name='sentence-transformers/all-MiniLM-L6-v2',
-        model_kwargs={'device': 'cpu'}
+    embeddings = get_embeddings()
+    
+    # Encode all chunks in large batches in a single call
+    raw_texts = [t.page_content for t in texts]
+    embs = embeddings.client.encode(
+        raw_texts,
+        batch_size=256,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True
     )
     
+    # The FP16 GPU model returns float16; FAISS and embs.npy expect float32
+    embs = embs.astype(np.float32, copy=False)
+    
     # Create FAISS vector store
     try:
-        db = FAISS.from_documents(texts, embeddings)
+        index = build_index(embs)
+        ids = [str(uuid.uuid4()) for _ in texts]
+        db = FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=InMemoryDocstore(dict(zip(ids, texts))),
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
         
         db.save_local(DB_FAISS_PATH)
+        
+        # Binary index for first-stage retrieval
+        faiss.write_index_binary(
+            build_binary_index(embs),
+            os.path.join(DB_FAISS_PATH, BINARY_INDEX_FILE)
+        )
+        
+        # Float32 embeddings (one contiguous row per chunk) for rescoring and
+        # for rebuilding indexes without re-encoding, see rebuild_index()
+        np.save(os.path.join(DB_FAISS_PATH, EMBEDDINGS_FILE), embs, allow_pickle=False)
+        
         print(f"Vector database successfully created and saved to {DB_FAISS_PATH}")
     
     except Exception as e:
@@ -75,20 +204,55 @@ def load_vector_db():
     """
     Optional method to load an existing vector database
     """
-    embeddings = HuggingFaceEmbeddings(
-        model_name='sentence-transformers/all-MiniLM-L6-v2',
-        model_kwargs={'device': 'cpu'}
-    )
+    embeddings = get_embeddings()
     
     try:
-        db = FAISS.load_local(DB_FAISS_PATH, embeddings)
+        db = FAISS.load_local(
+            DB_FAISS_PATH,
+            embeddings,
+            allow_dangerous_deserialization=True,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
         return db
     except Exception as e:
         print(f"Error loading vector database: {e}")
         return None
 
+def rebuild_index(index_factory_str):
+    """
+    Rebuild the FAISS index from the saved embeddings without re-encoding
+    
+    `index_factory_str` is a FAISS index factory string such as
+    "IVF1024,PQ32" or "HNSW32"; strings starting with "B" (e.g. "BIVF1024")
+    build a binary index over the quantized embeddings instead. Row order
+    is unchanged, so the saved docstore mapping stays valid
+    
+    The chatbot serves the binary index by default; set RETRIEVAL_INDEX =
+    'float' in model.py to serve a rebuilt float index
+    """
+    embs = np.load(os.path.join(DB_FAISS_PATH, EMBEDDINGS_FILE), mmap_mode='r')
+    
+    if index_factory_str.startswith('B'):
+        bin_embs = quantize_embeddings(embs, precision='ubinary')
+        index = faiss.index_binary_factory(EMBEDDING_DIM, index_factory_str)
+        index.train(bin_embs)
+        index.add(bin_embs)
+        if 'IVF' in index_factory_str:
+            index.nprobe = IVF_NPROBE
+        faiss.write_index_binary(index, os.path.join(DB_FAISS_PATH, BINARY_INDEX_FILE))
+    else:
+        index = faiss.index_factory(
+            EMBEDDING_DIM, index_factory_str, faiss.METRIC_INNER_PRODUCT
+        )
+        index.train(embs)
+        index.add(embs)
+        if 'IVF' in index_factory_str:
+            faiss.ParameterSpace().set_index_parameter(index, 'nprobe', IVF_NPROBE)
+        faiss.write_index(index, os.path.join(DB_FAISS_PATH, 'index.faiss'))
+    
+    return index
+
 if __name__ == "__main__":
-    import os
     os.makedirs('vectorstore', exist_ok=True)
     
     # Create the vector database